@@ -1,139 +1,341 @@
 import socket
 import struct
 import time
+import heapq
+import logging
+import selectors
 import threading
+from collections import deque
+
+import syscalls
+
+log = logging.getLogger('hudp.client')
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def _as_bytes(payload):
+    # str payloads are sent as UTF-8; bytes-like payloads go out untouched
+    return payload.encode('utf-8') if isinstance(payload, str) else payload
+
+
+class ClientMetrics:
+    __slots__ = (
+        'reliable_sent', 'unreliable_sent', 'packets_acked', 'retransmissions',
+        'bytes_sent', 'latencies', 'latency_sum', 'latency_min', 'latency_max'
+    )
+
+    def __init__(self, latency_window):
+        self.reliable_sent = 0
+        self.unreliable_sent = 0
+        self.packets_acked = 0
+        self.retransmissions = 0
+        self.bytes_sent = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.latency_sum = 0.0
+        self.latency_min = float('inf')
+        self.latency_max = 0.0
+
 
 class HUDPClient:
     HEADER_FORMAT = '<BQQ'
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+    HEADER_SIZE = HEADER_STRUCT.size
+    # Everything after the channel byte, for headers whose channel is preset
+    HEADER_TAIL_STRUCT = struct.Struct('<QQ')
     ACK_FORMAT = '<BQ'
-    ACK_SIZE = struct.calcsize(ACK_FORMAT)
+    ACK_STRUCT = struct.Struct(ACK_FORMAT)
+    ACK_SIZE = ACK_STRUCT.size
     
     TIMEOUT = 0.1
     MAX_THRESHOLD = 0.2
+    LATENCY_WINDOW = 4096
 
     def __init__(self, host, port):
         self.addr = (host, port)
         self.seqno = 0
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(0.1)
+        syscalls.tune_socket(self.socket)
+        self._recv_buf = bytearray(1024)
+        # One scratch header per channel with the channel byte already set, so
+        # a send only has to fill in seqno and timestamp
+        self._rel_hdr_buf = bytearray(HUDPClient.HEADER_SIZE)
+        self._rel_hdr_buf[0] = 0
+        self._unrel_hdr_buf = bytearray(HUDPClient.HEADER_SIZE)
+        self._unrel_hdr_buf[0] = 1
+        self._sockaddr = syscalls.make_sockaddr(self.addr) if syscalls.HAVE_MMSG else None
+        self._use_gso = syscalls.gso_supported(self.socket)
         
         self.running = True
+        self.metrics = ClientMetrics(HUDPClient.LATENCY_WINDOW)
+        # seqno -> [(header, payload), send_time, retries]; _deadlines is a min-heap of
+        # (retransmit_deadline, seqno) whose entries are dropped lazily once
+        # the seqno is no longer pending
         self.pending_packets = {}
+        self._deadlines = []
+        # _send_lock covers seqno, scratch header and send; _pending_lock the heap
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
 
-        threading.Thread(target=self._ack_listener, daemon=True).start()
-        threading.Thread(target=self._retransmit_checker, daemon=True).start()
+        # Self-pipe written when a new deadline becomes the earliest one, so
+        # the I/O loop can recompute its select() timeout
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
 
-        self.metrics = {
-            'packets_sent': {'reliable': 0, 'unreliable': 0},
-            'packets_acked': 0,
-            'retransmissions': 0,
-            'latencies': [],
-            'bytes_sent': 0
-        }
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self.socket, selectors.EVENT_READ, self._on_readable)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, self._on_wakeup)
 
-    def send_message(self, payload, isReliable=False):
+        self.threads = [
+            threading.Thread(target=self._io_loop, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _build_header(self, isReliable, seqno):
         timestamp_ms = int(time.time() * 1000)
         channel_type = 0 if isReliable else 1
 
-        header_bytes = struct.pack(
-            HUDPClient.HEADER_FORMAT,
+        return HUDPClient.HEADER_STRUCT.pack(
             channel_type,
-            self.seqno,
+            seqno,
             timestamp_ms
         )
 
-        payload_bytes = payload.encode('utf-8')
-        packet = header_bytes + payload_bytes
+    def _track(self, packets):
+        # Registered before the send, so an ACK that races the syscall back
+        # still finds its entry
+        send_time = time.time()
+        deadline = send_time + HUDPClient.TIMEOUT
+        with self._pending_lock:
+            earliest = not self._deadlines or deadline < self._deadlines[0][0]
+            for seqno, packet in packets:
+                self.pending_packets[seqno] = [packet, send_time, 0]
+                heapq.heappush(self._deadlines, (deadline, seqno))
+        if earliest:
+            self._wakeup()
 
-        self.socket.sendto(packet, self.addr)
-        print(f"Sent {'reliable' if isReliable else 'unreliable'} packet {self.seqno}")
+    def _untrack(self, seqnos):
+        # Their heap entries are skipped lazily like any acknowledged seqno
+        with self._pending_lock:
+            for seqno in seqnos:
+                self.pending_packets.pop(seqno, None)
 
-        if isReliable:
-            self.pending_packets[self.seqno] = {
-                'packet': packet,
-                'send_time': time.time(),
-                'retries': 0
-            }
+    def _on_sent(self, payload_bytes, isReliable):
+        log.debug("Sent %s packet %d", 'reliable' if isReliable else 'unreliable', self.seqno)
 
         self.seqno += 1
 
-        self.metrics['bytes_sent'] += len(packet)
+        self.metrics.bytes_sent += HUDPClient.HEADER_SIZE + len(payload_bytes)
         if isReliable:
-            self.metrics['packets_sent']['reliable'] += 1
+            self.metrics.reliable_sent += 1
         else:
-            self.metrics['packets_sent']['unreliable'] += 1
+            self.metrics.unreliable_sent += 1
+
+    def send_message(self, payload, isReliable=False):
+        payload_bytes = _as_bytes(payload)
+
+        hdr_buf = self._rel_hdr_buf if isReliable else self._unrel_hdr_buf
+
+        with self._send_lock:
+            HUDPClient.HEADER_TAIL_STRUCT.pack_into(
+                hdr_buf, 1,
+                self.seqno,
+                int(time.time() * 1000)
+            )
+
+            if isReliable:
+                # The scratch header is reused, so keep a copy for retransmission
+                self._track([(self.seqno, (bytes(hdr_buf), payload_bytes))])
 
-    def _ack_listener(self):
-        while self.running:
             try:
-                data, addr = self.socket.recvfrom(1024)
-                if len(data) >= struct.calcsize(HUDPClient.ACK_FORMAT):
-                    channel_type, ack_seqno = struct.unpack(
-                        HUDPClient.ACK_FORMAT,
-                        data[:HUDPClient.ACK_SIZE]
-                    )
-                    
-                    if channel_type == 255:
-                        if ack_seqno in self.pending_packets:
-                            rtt = time.time() - self.pending_packets[ack_seqno]['send_time']
-                            self.metrics['latencies'].append(rtt)
-                            self.metrics['packets_acked'] += 1
-                            del self.pending_packets[ack_seqno]
-                            print(f"ACK received for packet {ack_seqno}, RTT: {rtt*1000:.1f}ms")
-                            
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print(f"Error in ACK listener: {e}")
-                continue
-
-    def _retransmit_checker(self):
+                # Header and payload are gathered by the kernel, never concatenated
+                syscalls.sendv(self.socket, [hdr_buf, payload_bytes], self.addr)
+            except OSError:
+                if isReliable:
+                    self._untrack([self.seqno])
+                raise
+
+            self._on_sent(payload_bytes, isReliable)
+
+    def send_messages(self, payloads, isReliable=False):
+        payloads = list(payloads)
+
+        if not syscalls.HAVE_MMSG:
+            for payload in payloads:
+                self.send_message(payload, isReliable)
+            return
+
+        # sendmmsg maps payloads in place, which read-only views such as a
+        # memoryview over bytes cannot be; those are copied once here
+        payloads = [_as_bytes(payload) for payload in payloads]
+        payloads = [
+            payload if isinstance(payload, (bytes, bytearray)) else bytes(payload)
+            for payload in payloads
+        ]
+        while payloads:
+            with self._send_lock:
+                batch = [
+                    (self._build_header(isReliable, self.seqno + i), payload_bytes)
+                    for i, payload_bytes in enumerate(payloads[:syscalls.MAX_BATCH])
+                ]
+                if isReliable:
+                    self._track([(self.seqno + i, packet) for i, packet in enumerate(batch)])
+
+                try:
+                    sent = syscalls.sendmmsg(self.socket, batch, self._sockaddr)
+                except OSError:
+                    if isReliable:
+                        self._untrack(range(self.seqno, self.seqno + len(batch)))
+                    raise
+                if isReliable and sent < len(batch):
+                    self._untrack(range(self.seqno + sent, self.seqno + len(batch)))
+
+                for _, payload_bytes in batch[:sent]:
+                    self._on_sent(payload_bytes, isReliable)
+            payloads = payloads[sent:]
+
+    def _io_loop(self):
+        # The only I/O thread: ACK reads and retransmit deadlines share one
+        # select(), which sleeps until a datagram, a wakeup or the next deadline
         while self.running:
-            time.sleep(0.05)
-            current = time.time()
-            
-            for seqno, info in list(self.pending_packets.items()):
-                elapsed = current - info['send_time']
+            with self._pending_lock:
+                next_deadline = self._deadlines[0][0] if self._deadlines else None
+            timeout = None if next_deadline is None else max(0.0, next_deadline - time.time())
+
+            for key, _ in self._sel.select(timeout):
+                key.data()
+            if not self.running:
+                break
+
+            self._retransmit_due()
+
+    def _on_wakeup(self):
+        try:
+            self._wake_r.recv(4096)
+        except BlockingIOError:
+            pass
+
+    def _wakeup(self):
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            # A wakeup is already pending
+            pass
+
+    def _on_readable(self):
+        # Drains every queued ACK; the socket stays blocking for senders, so
+        # reads opt out of blocking per call
+        while True:
+            try:
+                nbytes, addr = self.socket.recvfrom_into(self._recv_buf, 0, _MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                log.warning("Error in ACK listener: %s", e)
+                return
+
+            if nbytes >= HUDPClient.ACK_SIZE:
+                channel_type, ack_seqno = HUDPClient.ACK_STRUCT.unpack_from(self._recv_buf)
                 
-                if elapsed > HUDPClient.TIMEOUT:
-                    if elapsed > HUDPClient.MAX_THRESHOLD:
-                        del self.pending_packets[seqno]
-                        print(f"Gave up on packet {seqno} after {elapsed*1000:.1f}ms")
-                    else:
-                        self.socket.sendto(info['packet'], self.addr)
-                        self.metrics['retransmissions'] += 1
-                        info['send_time'] = current
-                        info['retries'] += 1
-                        print(f"Retransmitting packet {seqno} (retry #{info['retries']})")
+                if channel_type == 255:
+                    info = self.pending_packets.pop(ack_seqno, None)
+                    if info is not None:
+                        rtt = time.time() - info[1]
+                        self.metrics.latencies.append(rtt)
+                        self.metrics.latency_sum += rtt
+                        if rtt < self.metrics.latency_min:
+                            self.metrics.latency_min = rtt
+                        if rtt > self.metrics.latency_max:
+                            self.metrics.latency_max = rtt
+                        self.metrics.packets_acked += 1
+                        log.debug("ACK received for packet %d, RTT: %.1fms", ack_seqno, rtt * 1000)
+
+            if not _MSG_DONTWAIT:
+                # Without MSG_DONTWAIT a second read could block; select again
+                return
+
+    def _retransmit_due(self):
+        current = time.time()
+        due = {}
+        
+        with self._pending_lock:
+            while self._deadlines and self._deadlines[0][0] <= current:
+                _, seqno = heapq.heappop(self._deadlines)
+                info = self.pending_packets.get(seqno)
+                if info is None:
+                    continue
+
+                packet, send_time, retries = info
+                elapsed = current - send_time
+                
+                if elapsed > HUDPClient.MAX_THRESHOLD:
+                    self.pending_packets.pop(seqno, None)
+                    log.info("Gave up on packet %d after %.1fms", seqno, elapsed * 1000)
+                else:
+                    due.setdefault(len(packet[1]), []).append(packet)
+                    info[1] = current
+                    info[2] = retries + 1
+                    heapq.heappush(self._deadlines, (current + HUDPClient.TIMEOUT, seqno))
+                    log.debug("Retransmitting packet %d (retry #%d)", seqno, info[2])
+
+        for packets in due.values():
+            try:
+                self._resend(packets)
+            except OSError as e:
+                # A transient send failure; the next deadline retries it
+                log.warning("Error in retransmit checker: %s", e)
+
+    def _resend(self, packets):
+        if self._use_gso and len(packets) > 1:
+            try:
+                syscalls.send_segmented(self.socket, packets, self.addr)
+                self.metrics.retransmissions += len(packets)
+                return
+            except OSError as e:
+                # Anything else only costs this group its segmentation
+                if e.errno in syscalls.GSO_UNSUPPORTED_ERRNOS:
+                    log.warning("UDP GSO unavailable, falling back to sendto: %s", e)
+                    self._use_gso = False
+
+        for packet in packets:
+            syscalls.sendv(self.socket, packet, self.addr)
+            self.metrics.retransmissions += 1
 
     def print_metrics(self):
         print("\n" + "="*50)
         print("CLIENT METRICS")
         print("="*50)
-        print(f"Packets Sent (Reliable): {self.metrics['packets_sent']['reliable']}")
-        print(f"Packets Sent (Unreliable): {self.metrics['packets_sent']['unreliable']}")
-        print(f"Packets ACKed: {self.metrics['packets_acked']}")
-        print(f"Retransmissions: {self.metrics['retransmissions']}")
+        print(f"Packets Sent (Reliable): {self.metrics.reliable_sent}")
+        print(f"Packets Sent (Unreliable): {self.metrics.unreliable_sent}")
+        print(f"Packets ACKed: {self.metrics.packets_acked}")
+        print(f"Retransmissions: {self.metrics.retransmissions}")
         
-        if self.metrics['latencies']:
-            latencies_ms = [l * 1000 for l in self.metrics['latencies']]
-            print(f"RTT Avg: {sum(latencies_ms)/len(latencies_ms):.2f} ms")
-            print(f"RTT Min: {min(latencies_ms):.2f} ms")
-            print(f"RTT Max: {max(latencies_ms):.2f} ms")
+        if self.metrics.packets_acked:
+            avg = self.metrics.latency_sum / self.metrics.packets_acked
+            print(f"RTT Avg: {avg*1000:.2f} ms")
+            print(f"RTT Min: {self.metrics.latency_min*1000:.2f} ms")
+            print(f"RTT Max: {self.metrics.latency_max*1000:.2f} ms")
         
-        print(f"Bytes Sent: {self.metrics['bytes_sent']}")
+        print(f"Bytes Sent: {self.metrics.bytes_sent}")
         print("="*50 + "\n")
 
     def close(self):
         self.running = False
-        time.sleep(0.2)
+        self._wakeup()
+        for thread in self.threads:
+            thread.join()
+        self._sel.close()
+        self._wake_r.close()
+        self._wake_w.close()
         self.socket.close()
         
         
         
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     
     client = HUDPClient('127.0.0.1', 65432)
     client.send_message("1", isReliable=True)
@@ -1,195 +1,372 @@
+import logging
+import selectors
 import socket
 import struct
 import threading
 import time
+from array import array
 from collections import deque
 
+import syscalls
+
+log = logging.getLogger('hudp.server')
+
+
+def decode_payload(payload, encoding='utf-8'):
+    return payload.decode(encoding)
+
+
+class ServerMetrics:
+    __slots__ = (
+        'reliable_received', 'unreliable_received', 'reliable_delivered',
+        'unreliable_delivered', 'packets_skipped', 'packets_dropped', 'bytes_received', 'jitter_ns',
+        'last_arrival', 'last_timestamp', 'start_time'
+    )
+
+    def __init__(self):
+        self.reliable_received = 0
+        self.unreliable_received = 0
+        self.reliable_delivered = 0
+        self.unreliable_delivered = 0
+        self.packets_skipped = 0
+        self.packets_dropped = 0
+        self.bytes_received = 0
+        self.jitter_ns = 0
+        self.last_arrival = None
+        self.last_timestamp = None
+        self.start_time = time.time()
+
+
 class HUDPServer:
     HEADER_FORMAT = '<BQQ'
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+    HEADER_SIZE = HEADER_STRUCT.size
     ACK_FORMAT = '<BQ'
+    ACK_STRUCT = struct.Struct(ACK_FORMAT)
     TIMEOUT_THRESHOLD = 0.2
+    RELIABLE_WINDOW = 4096
+    RELIABLE_MASK = RELIABLE_WINDOW - 1
+    WORD_MASK = (1 << 64) - 1
+    UNRELIABLE_CAPACITY = 65536
+    UNRELIABLE_MASK = UNRELIABLE_CAPACITY - 1
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, reuse_port=False):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        syscalls.tune_socket(self.socket)
+        if reuse_port:
+            # Lets several server processes share the port, one per core
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            syscalls.pin_incoming_cpu(self.socket)
         self.socket.bind((host, port))
         self.running = True
+        self.metrics = ServerMetrics()
 
-        self.reliable_buffer = {}
-        self.pending_packets = {}
+        # Reorder buffer indexed by seqno & RELIABLE_MASK, with one "filled"
+        # bit per slot packed into 64-bit words so lookups never touch a dict
+        self._ring = [None] * HUDPServer.RELIABLE_WINDOW
+        self._filled = array('Q', bytes(HUDPServer.RELIABLE_WINDOW // 8))
         self.next_expected_reliable = 0
-        self.gap_start_time = None
-
-        self.unreliable_queue = deque([])
-
-        threading.Thread(target=self._packet_receiver, daemon=True).start()
-        threading.Thread(target=self._timeout_checker, daemon=True).start()
-
-        self.metrics = {
-            'packets_received': {'reliable': 0, 'unreliable': 0},
-            'packets_delivered': {'reliable': 0, 'unreliable': 0},
-            'packets_skipped': 0,
-            'bytes_received': 0,
-            'jitter': 0.0,
-            'last_arrival': None,
-            'last_timestamp': None,
-            'start_time': time.time()
-        }
+        # Missing seqnos are tracked as (limit, first_seen) entries, appended
+        # whenever a packet jumps past the highest seqno seen so far: every
+        # seqno below limit that is still missing has been missing since
+        # first_seen. Entries are in seqno and time order, so the gap at
+        # next_expected_reliable is always described by the front entry.
+        self._gaps = deque()
+        self._highest_seen = -1
+        # Guards the ring, its bitmap, the gap list and next_expected_reliable
+        self._reliable_lock = threading.Lock()
+        # Set whenever next_expected_reliable turns into a known gap, so the
+        # timeout checker sleeps until that gap's deadline instead of polling
+        self._gap_wake = threading.Event()
+
+        # Single-producer/single-consumer ring kept as parallel arrays: the
+        # receiver only advances the tail and the application only the head
+        self._unrel_seqnos = array('Q', bytes(8 * HUDPServer.UNRELIABLE_CAPACITY))
+        self._unrel_payloads = [None] * HUDPServer.UNRELIABLE_CAPACITY
+        self._unrel_head = 0
+        self._unrel_tail = 0
+        self._batch_receiver = syscalls.MmsgReceiver(self.socket) if syscalls.HAVE_MMSG else None
+        self._recv_buf = bytearray(syscalls.RECV_BUFSIZE)
+        self._recv_view = memoryview(self._recv_buf)
+        # Only the receiver thread sends ACKs, so one scratch buffer is enough
+        self._ack_buf = bytearray(HUDPServer.ACK_STRUCT.size)
+
+        # The receiver waits in select() on the socket and a self-pipe that
+        # close() writes, since shutdown() on a UDP socket only wakes a blocked
+        # read on Linux
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self.socket, selectors.EVENT_READ)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+
+        self.threads = [
+            threading.Thread(target=self._packet_receiver, daemon=True),
+            threading.Thread(target=self._timeout_checker, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
         
-        print(f"Server listening on {host}:{port}")
+        log.info("Server listening on %s:%d", host, port)
 
     def _packet_receiver(self):
-        self.socket.settimeout(0.1)
-        
         while self.running:
-            try:
-                data, client_addr = self.socket.recvfrom(1024)
-                
-                if len(data) < HUDPServer.HEADER_SIZE:
-                    continue
+            self._sel.select()
+            if not self.running:
+                break
 
-                header = data[:HUDPServer.HEADER_SIZE]
-                channel_type, seqno, timestamp = struct.unpack(
-                    HUDPServer.HEADER_FORMAT,
-                    header
-                )
-                
-                payload = data[HUDPServer.HEADER_SIZE:].decode('utf-8')
-
-                if channel_type == 0:
-                    self.metrics['packets_received']['reliable'] += 1
-                    self.metrics['bytes_received'] += len(payload)
-                    arrival_time = time.time()
-                    self._calculate_jitter(timestamp, arrival_time)
-                    self._handle_reliable_channel(seqno, payload, client_addr)
-                elif channel_type == 1:
-                    self._handle_unreliable_channel(seqno, payload)
-                    
-            except socket.timeout:
-                continue
+            try:
+                if self._batch_receiver is not None:
+                    packets = self._batch_receiver.recv()
+                else:
+                    nbytes, client_addr = syscalls.recv_into(self.socket, self._recv_buf, syscalls.MSG_DONTWAIT)
+                    packets = [(self._recv_view, nbytes, client_addr)]
             except Exception as e:
                 continue
 
-    def _handle_reliable_channel(self, seqno, payload, client_addr):
-        ack = struct.pack(HUDPServer.ACK_FORMAT, 255, seqno)
-        self.socket.sendto(ack, client_addr)
-        print(f"[RELIABLE] Received packet {seqno}, sent ACK")
+            for data, nbytes, client_addr in packets:
+                try:
+                    self._handle_datagram(data, nbytes, client_addr)
+                except Exception as e:
+                    continue
 
-        if seqno < self.next_expected_reliable:
-            print(f"Duplicate, ignoring")
+    def _handle_datagram(self, data, nbytes, client_addr):
+        if nbytes < HUDPServer.HEADER_SIZE or nbytes > len(data):
+            # Runt or truncated (nbytes past the buffer): dropped
+            # before any per-packet object is built
+            self.metrics.packets_dropped += 1
             return
 
-        if seqno not in self.reliable_buffer:
-            self.reliable_buffer[seqno] = payload
-            if seqno in self.pending_packets:
-                del self.pending_packets[seqno]
-            if seqno > self.next_expected_reliable:
-                start_time = time.time()
-                for i in range(self.next_expected_reliable, seqno):
-                    if i in self.pending_packets or i in self.reliable_buffer: 
-                        continue
-                    self.pending_packets[i] = start_time
+        channel_type, seqno, timestamp = HUDPServer.HEADER_STRUCT.unpack_from(data)
+        if channel_type > 1:
+            self.metrics.packets_dropped += 1
+            return
+        
+        # Payloads are opaque bytes; decoding is left to the application
+        payload = bytes(data[HUDPServer.HEADER_SIZE:nbytes])
+
+        if channel_type == 0:
+            self.metrics.reliable_received += 1
+            self.metrics.bytes_received += len(payload)
+            self._calculate_jitter(timestamp, time.monotonic_ns())
+            self._handle_reliable_channel(seqno, payload, client_addr)
+        elif channel_type == 1:
+            self.metrics.unreliable_received += 1
+            self._handle_unreliable_channel(seqno, payload)
+
+    def _is_buffered(self, seqno):
+        idx = seqno & HUDPServer.RELIABLE_MASK
+        return (self._filled[idx >> 6] >> (idx & 63)) & 1
+
+    def _head_gap_start(self):
+        # Caller holds _reliable_lock. Returns when next_expected_reliable was
+        # first seen missing, or None if it is not (yet) a gap.
+        next_seqno = self.next_expected_reliable
+        while self._gaps and self._gaps[0][0] <= next_seqno:
+            self._gaps.popleft()
+        if not self._gaps or self._is_buffered(next_seqno):
+            return None
+        return self._gaps[0][1]
+
+    def _handle_reliable_channel(self, seqno, payload, client_addr):
+        if seqno >= self.next_expected_reliable + HUDPServer.RELIABLE_WINDOW:
+            # No slot to hold it yet; leave it unACKed so the client resends
+            log.debug("[RELIABLE] Packet %d outside receive window, dropping", seqno)
+            return
+
+        HUDPServer.ACK_STRUCT.pack_into(self._ack_buf, 0, 255, seqno)
+        self.socket.sendto(self._ack_buf, client_addr)
+        log.debug("[RELIABLE] Received packet %d, sent ACK", seqno)
+
+        with self._reliable_lock:
+            if seqno < self.next_expected_reliable:
+                log.debug("Duplicate %d, ignoring", seqno)
+                return
+
+            idx = seqno & HUDPServer.RELIABLE_MASK
+            bit = 1 << (idx & 63)
+            if self._filled[idx >> 6] & bit:
+                log.debug("Duplicate %d, ignoring", seqno)
+                return
+
+            self._ring[idx] = payload
+            self._filled[idx >> 6] |= bit
+
+            if seqno > self._highest_seen + 1:
+                head_was_gap = self._head_gap_start() is not None
+                self._gaps.append((seqno, time.time()))
+                if not head_was_gap:
+                    self._gap_wake.set()
+            if seqno > self._highest_seen:
+                self._highest_seen = seqno
 
     def _handle_unreliable_channel(self, seqno, payload):
-        print(f"[UNRELIABLE] Received packet {seqno}")
+        log.debug("[UNRELIABLE] Received packet %d", seqno)
 
-        self.unreliable_queue.append({
-            'seqno': seqno,
-            'payload': payload
-        })
+        tail = self._unrel_tail
+        if tail - self._unrel_head >= HUDPServer.UNRELIABLE_CAPACITY:
+            log.debug("[UNRELIABLE] Queue full, dropping packet %d", seqno)
+            return
 
-    def receive_reliable(self):
-        if self.next_expected_reliable in self.reliable_buffer:
-            payload = self.reliable_buffer[self.next_expected_reliable]
-            seqno = self.next_expected_reliable
-            
-            del self.reliable_buffer[seqno]
-            self.next_expected_reliable += 1
-            self.gap_start_time = None 
-            
-            print(f"[APP] Received reliable packet {seqno}: {payload}")
-            self.metrics['packets_delivered']['reliable'] += 1
-            return (seqno, payload)
+        idx = tail & HUDPServer.UNRELIABLE_MASK
+        self._unrel_seqnos[idx] = seqno
+        self._unrel_payloads[idx] = payload
+        self._unrel_tail = tail + 1
+
+    def _pop_reliable(self):
+        # Caller holds _reliable_lock
+        seqno = self.next_expected_reliable
+        if not self._is_buffered(seqno):
+            return None
+
+        idx = seqno & HUDPServer.RELIABLE_MASK
+        payload = self._ring[idx]
         
-        return None
+        self._ring[idx] = None
+        self._filled[idx >> 6] &= ~(1 << (idx & 63)) & HUDPServer.WORD_MASK
+        self.next_expected_reliable += 1
+        if self._head_gap_start() is not None:
+            self._gap_wake.set()
+        
+        log.debug("[APP] Received reliable packet %d: %s", seqno, payload)
+        return (seqno, payload)
+
+    def receive_reliable(self):
+        with self._reliable_lock:
+            packet = self._pop_reliable()
+
+        if packet is not None:
+            self.metrics.reliable_delivered += 1
+        return packet
+
+    def drain_reliable(self, max_n=64):
+        # Delivers up to max_n in-order packets under a single lock hold. Each
+        # step takes the whole run of consecutive filled bits from the current
+        # bitmap word, so in-order traffic clears up to 64 slots per word op.
+        packets = []
+        with self._reliable_lock:
+            while len(packets) < max_n:
+                seqno = self.next_expected_reliable
+                idx = seqno & HUDPServer.RELIABLE_MASK
+                shift = idx & 63
+                word = self._filled[idx >> 6] >> shift
+                run = min((word ^ (word + 1)).bit_length() - 1, max_n - len(packets))
+                if run == 0:
+                    break
+
+                for i in range(idx, idx + run):
+                    packets.append((seqno, self._ring[i]))
+                    self._ring[i] = None
+                    seqno += 1
+                self._filled[idx >> 6] &= ~(((1 << run) - 1) << shift) & HUDPServer.WORD_MASK
+                self.next_expected_reliable = seqno
+
+            if packets and self._head_gap_start() is not None:
+                self._gap_wake.set()
+
+        self.metrics.reliable_delivered += len(packets)
+        return packets
 
     def receive_unreliable(self):
-        if self.unreliable_queue:
-            packet = self.unreliable_queue.popleft()
-            seqno = packet['seqno']
-            payload = packet['payload']
+        head = self._unrel_head
+        if head != self._unrel_tail:
+            idx = head & HUDPServer.UNRELIABLE_MASK
+            seqno = self._unrel_seqnos[idx]
+            payload = self._unrel_payloads[idx]
+
+            self._unrel_payloads[idx] = None
+            self._unrel_head = head + 1
+            self.metrics.unreliable_delivered += 1
             
-            print(f"Received unreliable packet {seqno}: {payload}")
+            log.debug("Received unreliable packet %d: %s", seqno, payload)
             return (seqno, payload)
         
         return None
 
+    def drain_unreliable(self, max_n=64):
+        packets = []
+        while len(packets) < max_n:
+            packet = self.receive_unreliable()
+            if packet is None:
+                break
+            packets.append(packet)
+        return packets
+
     def _timeout_checker(self):
         while self.running:
-            time.sleep(0.01)
+            self._gap_wake.clear()
+            wait_for = None
             
-            if self.next_expected_reliable in self.pending_packets:
-                start_time = self.pending_packets[self.next_expected_reliable]
-                elapsed = time.time() - start_time
-               
-                if elapsed > HUDPServer.TIMEOUT_THRESHOLD:
-                    seqno = self.next_expected_reliable
-                    del self.pending_packets[seqno]
-                    print(f"[RELIABLE] Timeout waiting for packet {seqno}, skipping")
-                    self.metrics['packets_skipped'] += 1
-                    self.next_expected_reliable = seqno + 1
-
-    def _calculate_jitter(self, timestamp, arrival_time):
-        if self.metrics['last_arrival'] is not None:
-            D = (arrival_time - self.metrics['last_arrival']) - \
-                (timestamp - self.metrics['last_timestamp']) / 1000.0
-            self.metrics['jitter'] = self.metrics['jitter'] + (abs(D) - self.metrics['jitter']) / 16.0
+            with self._reliable_lock:
+                start_time = self._head_gap_start()
+                if start_time is not None:
+                    elapsed = time.time() - start_time
+                   
+                    if elapsed >= HUDPServer.TIMEOUT_THRESHOLD:
+                        seqno = self.next_expected_reliable
+                        log.info("[RELIABLE] Timeout waiting for packet %d, skipping", seqno)
+                        self.metrics.packets_skipped += 1
+                        self.next_expected_reliable = seqno + 1
+                        continue
+                    wait_for = HUDPServer.TIMEOUT_THRESHOLD - elapsed
+
+            self._gap_wake.wait(wait_for)
+
+    def _calculate_jitter(self, timestamp, arrival_ns):
+        # RFC 3550 estimator in integer nanoseconds; the shift is the 1/16 gain
+        if self.metrics.last_arrival is not None:
+            D = (arrival_ns - self.metrics.last_arrival) - \
+                (timestamp - self.metrics.last_timestamp) * 1_000_000
+            self.metrics.jitter_ns += (abs(D) - self.metrics.jitter_ns) >> 4
         
-        self.metrics['last_arrival'] = arrival_time
-        self.metrics['last_timestamp'] = timestamp
+        self.metrics.last_arrival = arrival_ns
+        self.metrics.last_timestamp = timestamp
 
     def print_metrics(self):
-        duration = time.time() - self.metrics['start_time']
+        duration = time.time() - self.metrics.start_time
         
         print("\n" + "="*50)
         print("SERVER METRICS")
         print("="*50)
-        print(f"Packets Received (Reliable): {self.metrics['packets_received']['reliable']}")
-        print(f"Packets Received (Unreliable): {self.metrics['packets_received']['unreliable']}")
-        print(f"Packets Delivered (Reliable): {self.metrics['packets_delivered']['reliable']}")
-        print(f"Packets Skipped: {self.metrics['packets_skipped']}")
-        print(f"Bytes Received: {self.metrics['bytes_received']}")
-        print(f"Throughput: {self.metrics['bytes_received'] / duration:.2f} bytes/sec")
-        print(f"Jitter: {self.metrics['jitter']*1000:.2f} ms")
+        print(f"Packets Received (Reliable): {self.metrics.reliable_received}")
+        print(f"Packets Received (Unreliable): {self.metrics.unreliable_received}")
+        print(f"Packets Delivered (Reliable): {self.metrics.reliable_delivered}")
+        print(f"Packets Skipped: {self.metrics.packets_skipped}")
+        print(f"Packets Dropped (Malformed): {self.metrics.packets_dropped}")
+        print(f"Bytes Received: {self.metrics.bytes_received}")
+        print(f"Throughput: {self.metrics.bytes_received / duration:.2f} bytes/sec")
+        print(f"Jitter: {self.metrics.jitter_ns / 1e6:.2f} ms")
         
         # Delivery ratio
-        reliable_ratio = (self.metrics['packets_delivered']['reliable'] / 
-                         self.metrics['packets_received']['reliable'] * 100) \
-                         if self.metrics['packets_received']['reliable'] > 0 else 0
+        reliable_ratio = (self.metrics.reliable_delivered / 
+                         self.metrics.reliable_received * 100) \
+                         if self.metrics.reliable_received > 0 else 0
         print(f"Reliable Delivery Ratio: {reliable_ratio:.2f}%")
         print("="*50 + "\n")
 
     def close(self):
         self.running = False
-        time.sleep(0.2)
+        self._gap_wake.set()
+        self._wake_w.send(b'\0')
+        for thread in self.threads:
+            thread.join()
+        self._sel.close()
+        self._wake_r.close()
+        self._wake_w.close()
         self.socket.close()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     server = HUDPServer('127.0.0.1', 65432)
     t = 1
     while t <= 6000:
         if t % 1000 == 0:
             server.print_metrics()
-        reliable_pkt = server.receive_reliable()
-        if reliable_pkt:
-            seqno, data = reliable_pkt
-            print(f"Reliable data: {data}")
-
-        unreliable_pkt = server.receive_unreliable()
-        if unreliable_pkt:
-            seqno, data = unreliable_pkt
-            print(f"Unreliable data: {data}")
+        for seqno, data in server.drain_reliable():
+            print(f"Reliable data: {decode_payload(data)}")
+
+        for seqno, data in server.drain_unreliable():
+            print(f"Unreliable data: {decode_payload(data)}")
 
         time.sleep(0.01)
         t += 1
@@ -0,0 +1,262 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+
+MAX_BATCH = 64
+RECV_BATCH = 32
+RECV_BUFSIZE = 2048
+MSG_WAITFORONE = 0x10000
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0)
+# Only Linux accepts MSG_TRUNC as an input flag that makes a receive report
+# the datagram's real length; elsewhere it is just an output bit in msg_flags
+RECV_TRUNC = MSG_TRUNC if sys.platform.startswith('linux') else 0
+HAVE_RECVMSG = hasattr(socket.socket, 'recvmsg_into')
+
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+MAX_GSO_SEGMENTS = 64
+# A GSO send is still one UDP datagram to the stack until it is segmented
+MAX_UDP_PAYLOAD = 65507
+# Errors meaning the device cannot segment at all. EMSGSIZE, and the EINVAL
+# for a segment larger than the path MTU, only rule out that one send.
+GSO_UNSUPPORTED_ERRNOS = (errno.EIO, errno.EOPNOTSUPP, errno.ENOPROTOOPT)
+
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+BUSY_POLL_USEC = 50
+SOCKET_BUFSIZE = 4 * 1024 * 1024
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_ushort),
+        ('sin_addr', ctypes.c_uint32),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+
+_libc = _load_libc()
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+HAVE_MMSG = _libc is not None and hasattr(_libc, 'sendmmsg') and hasattr(_libc, 'recvmmsg')
+
+if HAVE_MMSG:
+    # Declared prototypes let ctypes skip argument type inference per call
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int,
+                               ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+
+
+def make_sockaddr(addr):
+    host, port = addr
+    sa = sockaddr_in()
+    sa.sin_family = socket.AF_INET
+    sa.sin_port = socket.htons(port)
+    sa.sin_addr = int.from_bytes(socket.inet_aton(socket.gethostbyname(host)), sys.byteorder)
+    return sa
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _buffer_address(buf):
+    # bytes are immutable, so ctypes can only hand out a pointer to them
+    # through c_char_p; writable buffers are mapped in place
+    if isinstance(buf, bytes):
+        return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+def sendv(sock, buffers, addr):
+    # Sends one datagram gathered from several buffers without joining them
+    # in userspace first
+    if HAVE_SENDMSG:
+        return sock.sendmsg(buffers, [], 0, addr)
+    return sock.sendto(b''.join(buffers), addr)
+
+
+def recv_into(sock, buf, flags=0):
+    # Receives one datagram into buf as (nbytes, addr). A datagram that did
+    # not fit reports nbytes > len(buf), however the platform signals it.
+    if RECV_TRUNC or not HAVE_RECVMSG:
+        return sock.recvfrom_into(buf, 0, flags | RECV_TRUNC)
+    nbytes, _, msg_flags, addr = sock.recvmsg_into([buf], 0, flags)
+    if msg_flags & MSG_TRUNC:
+        nbytes = len(buf) + 1
+    return nbytes, addr
+
+
+def sendmmsg(sock, packets, sockaddr):
+    # Sends up to MAX_BATCH datagrams to sockaddr in a single syscall and
+    # returns how many the kernel accepted. Each packet is a sequence of
+    # buffers that becomes that datagram's iovec.
+    n = min(len(packets), MAX_BATCH)
+    iovs = (iovec * sum(len(packet) for packet in packets[:n]))()
+    msgs = (mmsghdr * n)()
+    name = ctypes.cast(ctypes.pointer(sockaddr), ctypes.c_void_p)
+
+    j = 0
+    for i in range(n):
+        packet = packets[i]
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = name
+        hdr.msg_namelen = ctypes.sizeof(sockaddr)
+        hdr.msg_iov = ctypes.pointer(iovs[j])
+        hdr.msg_iovlen = len(packet)
+
+        for buf in packet:
+            iovs[j].iov_base = _buffer_address(buf)
+            iovs[j].iov_len = len(buf)
+            j += 1
+
+    sent = _libc.sendmmsg(sock.fileno(), msgs, n, 0)
+    if sent < 0:
+        _raise_errno()
+    return sent
+
+
+class MmsgReceiver:
+    # Owns RECV_BATCH receive buffers that stay mapped into the mmsghdr array
+    # for the lifetime of the socket, so recvmmsg never allocates per packet.
+    # ctypes drops the GIL for the duration of the recvmmsg call itself.
+    def __init__(self, sock, vlen=RECV_BATCH, bufsize=RECV_BUFSIZE):
+        self.sock = sock
+        self.vlen = vlen
+        self.buffers = [bytearray(bufsize) for _ in range(vlen)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+
+        # Source address of the previous datagram, so a steady sender does not
+        # cost an inet_ntoa and a new tuple per packet
+        self._last_name = None
+        self._last_addr = None
+
+        self._names = (sockaddr_in * vlen)()
+        self._iovs = (iovec * vlen)()
+        self._msgs = (mmsghdr * vlen)()
+
+        for i in range(vlen):
+            self._iovs[i].iov_base = _buffer_address(self.buffers[i])
+            self._iovs[i].iov_len = bufsize
+
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._names[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        # Returns every datagram already queued (up to vlen) as
+        # (view, nbytes, addr), raising BlockingIOError if there is none. The
+        # views are only valid until the next call. With MSG_TRUNC, nbytes is
+        # the datagram's real length, so nbytes > len(view) means it was cut.
+        flags = MSG_WAITFORONE | MSG_DONTWAIT | RECV_TRUNC
+        n = _libc.recvmmsg(self.sock.fileno(), self._msgs, self.vlen, flags, None)
+        if n < 0:
+            _raise_errno()
+
+        packets = []
+        for i in range(n):
+            msg = self._msgs[i]
+            name = self._names[i]
+            key = (name.sin_addr, name.sin_port)
+            if key != self._last_name:
+                self._last_name = key
+                self._last_addr = (
+                    socket.inet_ntoa(name.sin_addr.to_bytes(4, sys.byteorder)),
+                    socket.ntohs(name.sin_port)
+                )
+            packets.append((self.views[i], msg.msg_len, self._last_addr))
+            # The kernel only rewrites namelen for slots it filled
+            msg.msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        return packets
+
+
+def gso_supported(sock):
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        sock.getsockopt(socket.SOL_UDP, UDP_SEGMENT)
+        return True
+    except OSError:
+        return False
+
+
+def send_segmented(sock, packets, addr):
+    # Hands equal-sized packets to the kernel as one gathered buffer and lets
+    # UDP GSO split it back into datagrams of that size
+    seg_size = sum(len(buf) for buf in packets[0])
+    cmsg = [(socket.SOL_UDP, UDP_SEGMENT, struct.pack('H', seg_size))]
+    step = max(1, min(MAX_GSO_SEGMENTS, MAX_UDP_PAYLOAD // seg_size))
+    for i in range(0, len(packets), step):
+        buffers = [buf for packet in packets[i:i + step] for buf in packet]
+        sock.sendmsg(buffers, cmsg, 0, addr)
+
+
+def tune_socket(sock, busy_poll_usec=BUSY_POLL_USEC, bufsize=SOCKET_BUFSIZE):
+    # Every knob is best effort: buffer sizes are capped by net.core.[rw]mem_max
+    # and raising SO_BUSY_POLL needs CAP_NET_ADMIN
+    opts = [(socket.SO_RCVBUF, bufsize), (socket.SO_SNDBUF, bufsize)]
+    if sys.platform.startswith('linux'):
+        opts.append((SO_BUSY_POLL, busy_poll_usec))
+
+    for opt, value in opts:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, opt, value)
+        except OSError:
+            pass
+
+
+def pin_incoming_cpu(sock):
+    # SO_INCOMING_CPU only steers traffic when the calling thread is pinned
+    # to a single core, so it is skipped otherwise
+    if not hasattr(socket, 'SO_INCOMING_CPU') or not hasattr(os, 'sched_getaffinity'):
+        return
+    cpus = os.sched_getaffinity(0)
+    if len(cpus) != 1:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_INCOMING_CPU, next(iter(cpus)))
+    except OSError:
+        pass